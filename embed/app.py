@@ -1,158 +1,787 @@
-from typing import List, Optional
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, TypeVar
 from fastapi import FastAPI
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer, CrossEncoder
 import uvicorn
 import torch
+import numpy as np
 import os
 from pathlib import Path
 
+# Let the Rust tokenizers batch-encode on multiple threads
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("embed")
+
 # Try to import ONNX Runtime optimizations (optional)
 try:
     import onnxruntime as ort
     ONNX_AVAILABLE = True
 except ImportError as e:
-    print(f"ONNX Runtime not available, using standard CrossEncoder: {e}")
+    logger.warning("ONNX Runtime not available, using standard CrossEncoder: %s", e)
     ONNX_AVAILABLE = False
 
-app: FastAPI = FastAPI()
-
-# Load model on startup
-model: SentenceTransformer = SentenceTransformer('all-MiniLM-L6-v2')  # 384 dimensions
-
 # Initialize ONNX-optimized reranker
 onnx_model_dir = Path("/tmp/reranker_onnx")
-reranker_onnx = None
-reranker_tokenizer = None
+trt_cache_dir = Path("/tmp/trt_cache")
+# One session per bucket, keyed by its fixed sequence length
+reranker_sessions: Dict[int, Any] = {}
+reranker_io_bindings: Dict[int, Any] = {}
+reranker_tokenizer: Optional[Any] = None
+
+RERANK_MAX_LENGTH = 512
+# ~6 characters per token is a safe upper bound for English, so anything past this
+# would be truncated by the tokenizer anyway
+RERANK_MAX_CHARS = RERANK_MAX_LENGTH * 6
+# Documents are grouped by pair length and each group runs on a model exported for
+# exactly that sequence length
+RERANK_BUCKETS = (128, 256, RERANK_MAX_LENGTH)
+# Rows per ORT call; bounds attention memory (batch x heads x seq^2) at the 512 bucket
+RERANK_ONNX_BATCH_SIZE = 32
+
+
+def quantize_onnx_model(onnx_model_path: Path) -> Path:
+    """Dynamically quantize an exported ONNX model to INT8, falling back to FP32 on failure"""
+    quantized_path = onnx_model_path.with_name(f"{onnx_model_path.stem}.int8.onnx")
+    if quantized_path.exists():
+        return quantized_path
+
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logger.info("Quantizing ONNX model to INT8...")
+        quantize_dynamic(
+            str(onnx_model_path),
+            str(quantized_path),
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=["MatMul", "Attention", "Gemm"]
+        )
+        logger.info("ONNX model quantized successfully!")
+        return quantized_path
+    except Exception as e:
+        logger.warning("INT8 quantization failed, using FP32 ONNX model: %s", e)
+        # Don't leave a partially written file behind to be picked up next start
+        quantized_path.unlink(missing_ok=True)
+        return onnx_model_path
+
+
+def select_onnx_providers() -> Tuple[List[str], List[Dict[str, str]]]:
+    """Pick the fastest available execution providers, always falling back to CPU"""
+    available = ort.get_available_providers()
+    providers = [
+        p for p in ("TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider")
+        if p in available
+    ]
+    provider_options: List[Dict[str, str]] = []
+    for provider in providers:
+        if provider == "TensorrtExecutionProvider":
+            trt_cache_dir.mkdir(parents=True, exist_ok=True)
+            provider_options.append({
+                "trt_fp16_enable": "1",
+                "trt_engine_cache_enable": "1",
+                "trt_engine_cache_path": str(trt_cache_dir),
+            })
+        else:
+            provider_options.append({})
+    return providers, provider_options
+
+
+def create_onnx_session(model_path: Path, static_shapes: bool = False) -> "ort.InferenceSession":
+    """Create an ONNX Runtime session, reusing the offline-optimized graph when cached"""
+    providers, provider_options = select_onnx_providers()
+    logger.info("ONNX Runtime execution providers: %s", providers)
+
+    def build_session_options() -> "ort.SessionOptions":
+        sess_options = ort.SessionOptions()
+        # Size thread pools to the host; override with ORT_INTRA_THREADS / ORT_INTER_THREADS
+        n = os.cpu_count() or 4
+        sess_options.intra_op_num_threads = int(os.getenv("ORT_INTRA_THREADS", n))
+        sess_options.inter_op_num_threads = int(os.getenv("ORT_INTER_THREADS", max(2, n // 4)))
+        sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        # With dynamic sequence lengths a planned memory pattern is never reused, so only
+        # plan for fixed-shape models; keep the CPU arena so buffers are still recycled
+        sess_options.enable_mem_pattern = static_shapes
+        return sess_options
+
+    if "TensorrtExecutionProvider" in providers:
+        # TensorRT compiles its own engines (cached in trt_cache_dir) and
+        # ORT can't serialize a graph containing compiled nodes
+        sess_options = build_session_options()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(
+            str(model_path),
+            sess_options,
+            providers=providers,
+            provider_options=provider_options
+        )
+
+    # Fused graphs are provider-specific, so cache CUDA and CPU variants separately
+    provider_tag = ".cuda" if "CUDAExecutionProvider" in providers else ""
+    optimized_path = model_path.with_name(f"{model_path.stem}{provider_tag}.opt.onnx")
+
+    if optimized_path.exists():
+        # Graph fusions were already applied and saved on a previous start
+        sess_options = build_session_options()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return ort.InferenceSession(
+                str(optimized_path),
+                sess_options,
+                providers=providers,
+                provider_options=provider_options
+            )
+        except Exception as e:
+            logger.warning("Failed to load optimized ONNX model, re-optimizing: %s", e)
+            optimized_path.unlink(missing_ok=True)
+
+    # First start: run all graph optimizations and persist the result
+    sess_options = build_session_options()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.optimized_model_filepath = str(optimized_path)
+    return ort.InferenceSession(
+        str(model_path),
+        sess_options,
+        providers=providers,
+        provider_options=provider_options
+    )
+
+
+def convert_onnx_model_to_fp16(onnx_model_path: Path) -> Path:
+    """Convert an exported ONNX model to FP16 weights, falling back to FP32 on failure"""
+    fp16_path = onnx_model_path.with_name(f"{onnx_model_path.stem}.fp16.onnx")
+    if fp16_path.exists():
+        return fp16_path
+
+    try:
+        import onnx
+        from onnxconverter_common import float16
+
+        logger.info("Converting ONNX model to FP16...")
+        # keep_io_types leaves the int64 token inputs and FP32 logits untouched
+        fp16_model = float16.convert_float_to_float16(
+            onnx.load(str(onnx_model_path)),
+            keep_io_types=True
+        )
+        onnx.save(fp16_model, str(fp16_path))
+        logger.info("ONNX model converted to FP16 successfully!")
+        return fp16_path
+    except Exception as e:
+        logger.warning("FP16 conversion failed, using FP32 ONNX model: %s", e)
+        fp16_path.unlink(missing_ok=True)
+        return onnx_model_path
+
+
+def select_onnx_model(onnx_model_path: Path) -> Path:
+    """Pick the FP16 graph when a GPU provider is available, otherwise the INT8 graph"""
+    # Dynamic INT8 ops have no CUDA kernels and would fall back to CPU on GPU hosts
+    providers, _ = select_onnx_providers()
+    if "TensorrtExecutionProvider" in providers or "CUDAExecutionProvider" in providers:
+        return convert_onnx_model_to_fp16(onnx_model_path)
+    return quantize_onnx_model(onnx_model_path)
+
+
+def load_reranker_tokenizer(model_name: str) -> Any:
+    """Load the reranker tokenizer from the ONNX cache dir, caching it there on first use"""
+    from transformers import AutoTokenizer
+
+    if (onnx_model_dir / "tokenizer_config.json").exists():
+        tokenizer = AutoTokenizer.from_pretrained(str(onnx_model_dir), use_fast=True)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        tokenizer.save_pretrained(str(onnx_model_dir))
+
+    if not tokenizer.is_fast:
+        logger.warning("Fast reranker tokenizer unavailable, tokenization will be slow")
+    return tokenizer
+
+
+def export_reranker_onnx(pt_model: Any, tokenizer: Any, seq_len: int, onnx_model_path: Path) -> None:
+    """Export the CrossEncoder to ONNX with a fixed sequence length and dynamic batch size"""
+    # Create dummy input for export (CrossEncoder format: query, document)
+    dummy_query = "test query"
+    dummy_doc = "test document"
+    dummy_inputs = tokenizer(
+        dummy_query,
+        dummy_doc,
+        return_tensors="pt",
+        truncation=True,
+        max_length=seq_len,
+        padding="max_length"
+    )
+
+    # Prepare inputs for export; segment ids must be graph inputs so the document
+    # tokens get segment 1 like they do in CrossEncoder.predict
+    input_ids = dummy_inputs["input_ids"]
+    attention_mask = dummy_inputs.get("attention_mask")
+    token_type_ids = dummy_inputs.get("token_type_ids", torch.zeros_like(input_ids))
+
+    if attention_mask is not None:
+        torch.onnx.export(
+            pt_model,
+            (input_ids, attention_mask, token_type_ids),
+            str(onnx_model_path),
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch_size"},
+                "attention_mask": {0: "batch_size"},
+                "token_type_ids": {0: "batch_size"},
+                "logits": {0: "batch_size"}
+            },
+            opset_version=14,
+            do_constant_folding=True
+        )
+    else:
+        torch.onnx.export(
+            pt_model,
+            (input_ids, {"token_type_ids": token_type_ids}),
+            str(onnx_model_path),
+            input_names=["input_ids", "token_type_ids"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch_size"},
+                "token_type_ids": {0: "batch_size"},
+                "logits": {0: "batch_size"}
+            },
+            opset_version=14,
+            do_constant_folding=True
+        )
+
 
 def initialize_onnx_reranker() -> bool:
     """Initialize ONNX Runtime optimized reranker for faster inference"""
-    global reranker_onnx, reranker_tokenizer
+    global reranker_sessions, reranker_io_bindings, reranker_tokenizer
     
     if not ONNX_AVAILABLE:
-        print("ONNX Runtime not available, skipping ONNX optimization")
+        logger.info("ONNX Runtime not available, skipping ONNX optimization")
         return False
     
     model_name = "cross-encoder/ms-marco-MiniLM-L-6-v2"
-    onnx_model_path = onnx_model_dir / "model.onnx"
+    onnx_model_paths = {
+        seq_len: onnx_model_dir / f"model.seq{seq_len}.onnx" for seq_len in RERANK_BUCKETS
+    }
     
     try:
-        # Check if ONNX model already exists
-        if onnx_model_path.exists():
-            print("Loading existing ONNX model...")
-            # Create ONNX Runtime session
-            sess_options = ort.SessionOptions()
-            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            sess_options.intra_op_num_threads = 4
-            sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-            
-            reranker_onnx = ort.InferenceSession(
-                str(onnx_model_path),
-                sess_options,
-                providers=["CPUExecutionProvider"]
-            )
-            # Use CrossEncoder to get the exact tokenizer it uses
-            temp_ce = CrossEncoder(model_name)
-            reranker_tokenizer = temp_ce.tokenizer
-            del temp_ce  # Clean up
-            print("ONNX Runtime reranker loaded successfully!")
-            return True
+        # Fast tokenizer, cached next to the models so later starts are fully offline
+        onnx_model_dir.mkdir(parents=True, exist_ok=True)
+        reranker_tokenizer = load_reranker_tokenizer(model_name)
+
+        # Check if the ONNX models already exist
+        missing = [seq_len for seq_len, path in onnx_model_paths.items() if not path.exists()]
+        if not missing:
+            # Only the tokenizer is needed here, not the PyTorch weights
+            logger.info("Loading existing ONNX models...")
         else:
-            print("Converting CrossEncoder to ONNX format using torch.onnx.export...")
+            logger.info("Converting CrossEncoder to ONNX format using torch.onnx.export...")
             
-            # Load CrossEncoder to get the exact model and tokenizer it uses
+            # Load CrossEncoder to get the exact model it uses
             temp_ce = CrossEncoder(model_name)
             pt_model = temp_ce.model
             pt_model.eval()
-            reranker_tokenizer = temp_ce.tokenizer
-            
-            # Create dummy input for export (CrossEncoder format: query, document)
-            dummy_query = "test query"
-            dummy_doc = "test document"
-            dummy_inputs = reranker_tokenizer(
-                dummy_query,
-                dummy_doc,
-                return_tensors="pt",
-                truncation=True,
-                max_length=512,
-                padding=True
-            )
-            
-            # Export to ONNX using torch.onnx.export
-            onnx_model_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Prepare inputs for export
-            input_ids = dummy_inputs["input_ids"]
-            attention_mask = dummy_inputs.get("attention_mask")
-            
-            if attention_mask is not None:
-                torch.onnx.export(
-                    pt_model,
-                    (input_ids, attention_mask),
-                    str(onnx_model_path),
-                    input_names=["input_ids", "attention_mask"],
-                    output_names=["logits"],
-                    dynamic_axes={
-                        "input_ids": {0: "batch_size", 1: "sequence_length"},
-                        "attention_mask": {0: "batch_size", 1: "sequence_length"},
-                        "logits": {0: "batch_size"}
-                    },
-                    opset_version=14,
-                    do_constant_folding=True
-                )
-            else:
-                torch.onnx.export(
-                    pt_model,
-                    input_ids,
-                    str(onnx_model_path),
-                    input_names=["input_ids"],
-                    output_names=["logits"],
-                    dynamic_axes={
-                        "input_ids": {0: "batch_size", 1: "sequence_length"},
-                        "logits": {0: "batch_size"}
-                    },
-                    opset_version=14,
-                    do_constant_folding=True
-                )
             
+            # Export one model per bucket sequence length
+            for seq_len in missing:
+                export_reranker_onnx(pt_model, reranker_tokenizer, seq_len, onnx_model_paths[seq_len])
+
             # Clean up temporary CrossEncoder
             del temp_ce
             
-            print("ONNX model exported successfully!")
-            
-            # Load the ONNX model with optimizations
-            sess_options = ort.SessionOptions()
-            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            sess_options.intra_op_num_threads = 4
-            sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-            
-            reranker_onnx = ort.InferenceSession(
+            logger.info("ONNX models exported successfully!")
+        
+        # Load the ONNX models with optimizations; fixed shapes let ORT plan memory up front
+        sessions = {
+            seq_len: create_onnx_session(select_onnx_model(path), static_shapes=True)
+            for seq_len, path in onnx_model_paths.items()
+        }
+        reranker_sessions = sessions
+        reranker_io_bindings = {seq_len: session.io_binding() for seq_len, session in sessions.items()}
+        
+        logger.info("ONNX Runtime reranker initialized successfully!")
+        return True
+    except Exception as e:
+        logger.exception("Failed to initialize ONNX reranker: %s", e)
+        logger.info("Falling back to standard CrossEncoder...")
+        return False
+
+
+# Set by load_models() inside the inference worker process
+use_onnx = False
+reranker: Optional[CrossEncoder] = None
+
+
+# Initialize ONNX-optimized embedding encoder
+EMBED_MODEL_NAME = 'all-MiniLM-L6-v2'  # 384 dimensions
+EMBED_BATCH_SIZE = 64
+encoder_onnx_dir = Path("/tmp/encoder_onnx")
+
+
+class OnnxSentenceEncoder:
+    """Sentence encoder running an ONNX transformer with mean pooling and L2 normalization"""
+
+    def __init__(self, session: "ort.InferenceSession", tokenizer: Any, max_length: int) -> None:
+        self.session = session
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.input_names = [inp.name for inp in session.get_inputs()]
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        # Batch texts of similar length together to minimize padding
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings: List[np.ndarray] = []
+        for start in range(0, len(texts), batch_size):
+            batch = [texts[i] for i in order[start:start + batch_size]]
+            inputs = self.tokenizer(
+                batch,
+                return_tensors="np",
+                truncation=True,
+                max_length=self.max_length,
+                padding=True
+            )
+            onnx_inputs = {
+                name: np.ascontiguousarray(inputs[name], dtype=np.int64)
+                for name in self.input_names
+                if name in inputs
+            }
+            token_embeddings = self.session.run(None, onnx_inputs)[0]
+
+            # Mean pooling over real (non-padding) tokens
+            mask = onnx_inputs["attention_mask"][:, :, None].astype(np.float32)
+            summed = (token_embeddings * mask).sum(axis=1)
+            counts = np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled = summed / counts
+
+            norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.append(pooled / norms)
+
+        # Restore the caller's input order
+        result = np.empty((len(texts), embeddings[0].shape[1]), dtype=np.float32)
+        result[order] = np.concatenate(embeddings)
+        return result
+
+
+def initialize_onnx_encoder() -> Optional[OnnxSentenceEncoder]:
+    """Initialize an INT8 ONNX Runtime encoder for faster /embed inference"""
+    if not ONNX_AVAILABLE:
+        logger.info("ONNX Runtime not available, skipping ONNX encoder optimization")
+        return None
+
+    onnx_model_path = encoder_onnx_dir / "model.onnx"
+
+    try:
+        if not onnx_model_path.exists():
+            logger.info("Converting SentenceTransformer to ONNX format using torch.onnx.export...")
+
+            temp_st = SentenceTransformer(EMBED_MODEL_NAME)
+            pt_model = temp_st[0].auto_model
+            pt_model.eval()
+            tokenizer = temp_st.tokenizer
+
+            dummy_inputs = tokenizer(["test sentence"], return_tensors="pt", padding=True)
+            input_names = [
+                name for name in ("input_ids", "attention_mask", "token_type_ids")
+                if name in dummy_inputs
+            ]
+
+            encoder_onnx_dir.mkdir(parents=True, exist_ok=True)
+            dynamic_axes = {
+                name: {0: "batch_size", 1: "sequence_length"} for name in input_names
+            }
+            dynamic_axes["last_hidden_state"] = {0: "batch_size", 1: "sequence_length"}
+            torch.onnx.export(
+                pt_model,
+                tuple(dummy_inputs[name] for name in input_names),
                 str(onnx_model_path),
-                sess_options,
-                providers=["CPUExecutionProvider"]
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+                do_constant_folding=True
             )
-            
-            print("ONNX Runtime reranker initialized successfully!")
-            return True
+
+            # Keep tokenizer and sequence limit next to the model so later starts skip PyTorch
+            tokenizer.save_pretrained(str(encoder_onnx_dir))
+            (encoder_onnx_dir / "max_seq_length").write_text(str(temp_st.max_seq_length))
+            del temp_st
+            logger.info("ONNX encoder exported successfully!")
+
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(str(encoder_onnx_dir), use_fast=True)
+        if not tokenizer.is_fast:
+            logger.warning("Fast encoder tokenizer unavailable, tokenization will be slow")
+        max_length = int((encoder_onnx_dir / "max_seq_length").read_text())
+        session = create_onnx_session(select_onnx_model(onnx_model_path))
+        logger.info("ONNX Runtime encoder initialized successfully!")
+        return OnnxSentenceEncoder(session, tokenizer, max_length)
     except Exception as e:
-        print(f"Failed to initialize ONNX reranker: {e}")
-        import traceback
-        traceback.print_exc()
-        print("Falling back to standard CrossEncoder...")
-        return False
+        logger.exception("Failed to initialize ONNX encoder: %s", e)
+        logger.info("Falling back to standard SentenceTransformer...")
+        return None
+
+
+# Set by load_models() inside the inference worker process
+encoder: Optional[OnnxSentenceEncoder] = None
+model: Optional[SentenceTransformer] = None
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts with the ONNX encoder, or the SentenceTransformer fallback"""
+    if encoder is not None:
+        return encoder.encode(texts, batch_size=EMBED_BATCH_SIZE)
+    if model is None:
+        raise RuntimeError("Embedding model is not loaded")
+    return np.asarray(model.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False
+    ))
+
+
+def tokenize_rerank_pairs(
+    tokenizer: Any, query: str, documents: List[str]
+) -> Tuple[List[int], List[List[int]]]:
+    """Tokenize the query once and each document without special tokens"""
+    # Queries are short in practice; cap at half the window so documents keep room
+    q_ids = tokenizer(query, add_special_tokens=False)["input_ids"][:RERANK_MAX_LENGTH // 2]
+    prefix = [tokenizer.cls_token_id, *q_ids, tokenizer.sep_token_id]
+    d_ids = tokenizer(
+        documents,
+        add_special_tokens=False,
+        truncation=True,
+        max_length=RERANK_MAX_LENGTH - len(prefix) - 1
+    )["input_ids"]
+    return prefix, d_ids
+
+
+def build_rerank_inputs(
+    tokenizer: Any, rows: List[Tuple[List[int], List[int]]], seq_len: int
+) -> Dict[str, np.ndarray]:
+    """Pack (prefix, doc) rows into [CLS] query [SEP] doc [SEP] arrays padded to seq_len"""
+    # Pad to the bucket's fixed length in one allocation and fill each row by slicing
+    prefix_lengths = np.array([len(prefix) for prefix, _ in rows], dtype=np.int64)
+    lengths = np.array([len(prefix) + len(ids) + 1 for prefix, ids in rows], dtype=np.int64)
+    input_ids = np.full((len(rows), seq_len), tokenizer.pad_token_id, dtype=np.int64)
+    for row, (prefix, ids) in enumerate(rows):
+        end = len(prefix) + len(ids)
+        input_ids[row, :len(prefix)] = prefix
+        input_ids[row, len(prefix):end] = ids
+        input_ids[row, end] = tokenizer.sep_token_id
+
+    positions = np.arange(seq_len)
+    attention_mask = (positions < lengths[:, None]).astype(np.int64)
+    token_type_ids = ((positions >= prefix_lengths[:, None]) & (attention_mask == 1)).astype(np.int64)
+
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "token_type_ids": token_type_ids,
+    }
+
+
+def extract_scores(output_tensor: np.ndarray) -> np.ndarray:
+    """Extract one relevance score per row from the reranker output"""
+    # [batch, 2] are binary classification logits: use the positive class.
+    # [batch, 1] and [batch] already hold one relevance score per row.
+    if output_tensor.ndim == 2 and output_tensor.shape[1] == 2:
+        return output_tensor[:, 1]
+    if output_tensor.ndim > 2 or (output_tensor.ndim == 2 and output_tensor.shape[1] != 1):
+        logger.warning(
+            "Unexpected ONNX output shape %s, using first value per row", output_tensor.shape
+        )
+    return output_tensor.reshape(output_tensor.shape[0], -1)[:, 0]
+
+
+def run_onnx_reranker(inputs: Dict[str, np.ndarray], seq_len: int) -> np.ndarray:
+    """Run one packed batch through the ONNX reranker session exported for seq_len"""
+    session = reranker_sessions[seq_len]
+    io_binding = reranker_io_bindings[seq_len]
+
+    # Bind the int64 arrays directly to the model's expected inputs
+    for inp in session.get_inputs():
+        if inp.name in inputs:
+            io_binding.bind_cpu_input(inp.name, inputs[inp.name])
+    io_binding.bind_output(session.get_outputs()[0].name)
+
+    session.run_with_iobinding(io_binding)
+    return np.asarray(io_binding.copy_outputs_to_cpu()[0])
+
+
+def rerank_with_onnx(requests: List[Tuple[str, List[str]]]) -> List[List[float]]:
+    """Score every (query, documents) request together, one inference per length bucket"""
+    tokenizer = reranker_tokenizer
+    if tokenizer is None:
+        raise RuntimeError("ONNX reranker tokenizer is not loaded")
+
+    rows: List[Tuple[List[int], List[int]]] = []
+    for query, documents in requests:
+        prefix, d_ids = tokenize_rerank_pairs(tokenizer, query, documents)
+        rows.extend((prefix, ids) for ids in d_ids)
+
+    # Sort by true pair length, then split at the bucket boundaries
+    lengths = np.array([len(prefix) + len(ids) + 1 for prefix, ids in rows])
+    order = np.argsort(lengths, kind="stable")
+    boundaries = np.searchsorted(lengths[order], RERANK_BUCKETS[:-1], side="right")
+
+    # Scatter each bucket's scores back to the original row order
+    scores = np.empty(len(rows), dtype=np.float32)
+    for index, bucket in enumerate(np.split(order, boundaries)):
+        seq_len = RERANK_BUCKETS[index]
+        for start in range(0, len(bucket), RERANK_ONNX_BATCH_SIZE):
+            chunk = bucket[start:start + RERANK_ONNX_BATCH_SIZE]
+            inputs = build_rerank_inputs(tokenizer, [rows[i] for i in chunk], seq_len)
+            scores[chunk] = extract_scores(run_onnx_reranker(inputs, seq_len))
+
+    # One C-level conversion to Python floats instead of a float() call per score
+    return split_scores(scores.tolist(), requests)
+
+
+def split_scores(scores: List[float], requests: List[Tuple[str, List[str]]]) -> List[List[float]]:
+    """Slice a flat list of pair scores back into one list per request"""
+    results: List[List[float]] = []
+    start = 0
+    for _, documents in requests:
+        results.append(scores[start:start + len(documents)])
+        start += len(documents)
+    return results
+
+
+def rerank_batch(requests: List[Tuple[str, List[str]]]) -> List[List[float]]:
+    """Score a batch of rerank requests with the ONNX reranker, or the CrossEncoder fallback"""
+    # Clip long documents before tokenizing so the tokenizer doesn't process text it
+    # will truncate away; truncation=True still enforces the exact token limit
+    requests = [
+        (query, [doc[:RERANK_MAX_CHARS] for doc in documents])
+        for query, documents in requests
+    ]
+
+    if use_onnx and reranker_sessions and reranker_tokenizer is not None:
+        # Use ONNX Runtime optimized reranking with batch processing
+        return rerank_with_onnx(requests)
+    else:
+        # Fallback to standard CrossEncoder
+        if reranker is None:
+            raise RuntimeError("CrossEncoder reranker is not loaded")
+        pairs = [[query, doc] for query, documents in requests for doc in documents]
+        return split_scores(reranker.predict(pairs).tolist(), requests)
+
+
+def optimize_torch_reranker(cross_encoder: CrossEncoder) -> None:
+    """Speed up the PyTorch CrossEncoder fallback with BetterTransformer and torch.compile"""
+    try:
+        # Optional: fused attention kernels that skip padding tokens
+        from optimum.bettertransformer import BetterTransformer
+
+        cross_encoder.model = BetterTransformer.transform(
+            cross_encoder.model, keep_original_model=False
+        )
+        logger.info("CrossEncoder converted to BetterTransformer")
+    except Exception as e:
+        logger.info("BetterTransformer not applied: %s", e)
+
+    if hasattr(torch, "compile"):
+        eager_model = cross_encoder.model
+        try:
+            cross_encoder.model = torch.compile(eager_model, mode="reduce-overhead", dynamic=True)
+            # Compilation is lazy, so run one prediction now to surface failures at startup
+            cross_encoder.predict([["warm up query", "warm up document"]])
+            logger.info("CrossEncoder compiled with torch.compile")
+        except Exception as e:
+            logger.warning("torch.compile not applied, using eager CrossEncoder: %s", e)
+            cross_encoder.model = eager_model
+
+
+def load_models() -> None:
+    """Load the embedding and reranking models; runs once in the inference worker process"""
+    global use_onnx, reranker, encoder, model
+
+    # Try to initialize ONNX reranker, fallback to standard if it fails
+    use_onnx = initialize_onnx_reranker()
+
+    if not use_onnx:
+        # Fallback to standard CrossEncoder with optimizations
+        reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+        reranker.model.eval()
+        if hasattr(torch, 'set_num_threads'):
+            torch.set_num_threads(4)
+        torch.set_grad_enabled(False)
+        optimize_torch_reranker(reranker)
+
+    # Try to initialize ONNX encoder, fallback to standard if it fails
+    encoder = initialize_onnx_encoder()
+    if encoder is None:
+        model = SentenceTransformer(EMBED_MODEL_NAME)
+
+
+def ping() -> None:
+    """No-op task used to make the inference worker start and load models"""
+
 
-# Try to initialize ONNX reranker, fallback to standard if it fails
-use_onnx = initialize_onnx_reranker()
+# Inference is CPU-bound and holds the GIL between native calls, so it runs in a
+# separate process and the event loop stays free to accept requests
+inference_pool: Optional[ProcessPoolExecutor] = None
 
-if not use_onnx:
-    # Fallback to standard CrossEncoder with optimizations
-    reranker: CrossEncoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
-    reranker.model.eval()
-    if hasattr(torch, 'set_num_threads'):
-        torch.set_num_threads(4)
-    torch.set_grad_enabled(False)
-else:
-    reranker = None  # Will use ONNX model instead
+T = TypeVar("T")
+
+
+def create_inference_pool() -> ProcessPoolExecutor:
+    # Spawn rather than fork so the worker doesn't inherit torch/ORT thread state
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_models
+    )
+
+
+async def run_inference(func: Callable[..., T], *args: Any) -> T:
+    """Run func in the inference worker, replacing the pool if the worker has died"""
+    global inference_pool
+
+    pool = inference_pool
+    if pool is None:
+        raise RuntimeError("Inference worker is not running")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A crashed worker (OOM kill, native crash) leaves the pool unusable for good,
+        # so start a fresh one; concurrent callers only replace it once
+        if inference_pool is pool:
+            logger.error("Inference worker died, starting a new one")
+            inference_pool = create_inference_pool()
+            pool.shutdown(wait=False)
+        raise
+
+RERANK_MAX_BATCH = 16
+RERANK_MAX_ROWS = 256
+RERANK_MAX_WAIT_MS = 5
+
+
+class RerankBatcher:
+    """Coalesces concurrent /rerank calls into a single inference worker round trip"""
+
+    def __init__(
+        self,
+        max_batch: int = RERANK_MAX_BATCH,
+        max_rows: int = RERANK_MAX_ROWS,
+        max_wait_ms: float = RERANK_MAX_WAIT_MS
+    ) -> None:
+        self.max_batch = max_batch
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue: "asyncio.Queue[Tuple[str, List[str], asyncio.Future[List[float]]]]" = (
+            asyncio.Queue()
+        )
+        self.task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+
+    async def submit(self, query: str, documents: List[str]) -> List[float]:
+        future: "asyncio.Future[List[float]]" = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, documents, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for one request, then gather whatever else arrives within max_wait,
+            # stopping early once enough requests or document rows are pending
+            pending = [await self.queue.get()]
+            rows = len(pending[0][1])
+            deadline = loop.time() + self.max_wait
+            while len(pending) < self.max_batch and rows < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                rows += len(pending[-1][1])
+
+            requests = [(query, documents) for query, documents, _ in pending]
+            try:
+                results = await run_inference(rerank_batch, requests)
+            except Exception as e:
+                for _, _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # Callers that disconnected have already cancelled their futures
+            for index, (_, _, future) in enumerate(pending):
+                if not future.done():
+                    future.set_result(results[index])
+
+
+rerank_batcher: Optional[RerankBatcher] = None
+
+RERANK_CACHE_SIZE = 50000
+
+
+def hash_text(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class ScoreCache:
+    """Bounded LRU of rerank scores keyed by (query hash, document hash)"""
+
+    def __init__(self, maxsize: int = RERANK_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[bytes, bytes], float]" = OrderedDict()
+
+    def get(self, key: Tuple[bytes, bytes]) -> Optional[float]:
+        score = self.entries.get(key)
+        if score is not None:
+            self.entries.move_to_end(key)
+        return score
+
+    def put(self, key: Tuple[bytes, bytes], score: float) -> None:
+        self.entries[key] = score
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+# Only touched from the event loop, so no locking is needed
+score_cache = ScoreCache()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global inference_pool, rerank_batcher
+
+    inference_pool = create_inference_pool()
+    # Load models before accepting traffic instead of on the first request
+    await run_inference(ping)
+    rerank_batcher = RerankBatcher()
+    rerank_batcher.start()
+    yield
+    await rerank_batcher.stop()
+    if inference_pool is not None:
+        inference_pool.shutdown()
+
+
+app: FastAPI = FastAPI(lifespan=lifespan)
 
 
 class EmbedRequest(BaseModel):
@@ -178,7 +807,8 @@ class HealthResponse(BaseModel):
 
 @app.post("/embed", response_model=EmbedResponse)
 async def embed(request: EmbedRequest) -> EmbedResponse:
-    embeddings: List[List[float]] = model.encode(request.texts).tolist()
+    encoded = await run_inference(encode_texts, request.texts)
+    embeddings: List[List[float]] = encoded.tolist()
     return EmbedResponse(embeddings=embeddings)
 
 
@@ -187,68 +817,24 @@ async def rerank(request: RerankRequest) -> RerankResponse:
     if not request.documents:
         return RerankResponse(scores=[])
     
-    if use_onnx and reranker_onnx is not None and reranker_tokenizer is not None:
-        # Use ONNX Runtime optimized reranking with batch processing
-        # Get input names from ONNX model
-        input_names = [inp.name for inp in reranker_onnx.get_inputs()]
-        
-        # Batch tokenize all query-document pairs (CrossEncoder format)
-        # Tokenizer expects text and text_pair as separate lists for batch processing
-        queries = [request.query] * len(request.documents)
-        documents = request.documents
-        
-        inputs = reranker_tokenizer(
-            queries,
-            documents,
-            return_tensors="np",  # ONNX Runtime expects numpy arrays
-            truncation=True,
-            max_length=512,
-            padding=True
+    # Serve repeated (query, document) pairs from the cache; only misses hit the model
+    query_hash = hash_text(request.query)
+    keys = [(query_hash, hash_text(doc)) for doc in request.documents]
+    cached = [score_cache.get(key) for key in keys]
+    misses = [index for index, score in enumerate(cached) if score is None]
+
+    if misses:
+        if rerank_batcher is None:
+            raise RuntimeError("Rerank batcher is not running")
+        miss_scores = await rerank_batcher.submit(
+            request.query, [request.documents[index] for index in misses]
         )
-        
-        # Prepare inputs for ONNX Runtime based on model's expected inputs
-        onnx_inputs = {}
-        if "input_ids" in input_names:
-            onnx_inputs["input_ids"] = inputs["input_ids"].astype("int64")
-        if "attention_mask" in input_names and "attention_mask" in inputs:
-            onnx_inputs["attention_mask"] = inputs["attention_mask"].astype("int64")
-        
-        # Run batch inference with ONNX Runtime
-        outputs = reranker_onnx.run(None, onnx_inputs)
-        
-        # Extract scores based on output shape
-        # Different models may have different output formats:
-        # - [batch, 2]: Binary classification logits, use [:, 1] for relevance score
-        # - [batch, 1]: Single relevance score per document
-        # - [batch]: Flattened relevance scores
-        output_tensor = outputs[0]
-        output_shape = output_tensor.shape
-        
-        if len(output_shape) == 1:
-            # Shape: [batch] - direct scores
-            scores = [float(score) for score in output_tensor]
-        elif len(output_shape) == 2:
-            if output_shape[1] == 1:
-                # Shape: [batch, 1] - squeeze to get scores
-                scores = [float(score) for score in output_tensor[:, 0]]
-            elif output_shape[1] == 2:
-                # Shape: [batch, 2] - binary classification, use positive class logit
-                scores = [float(score) for score in output_tensor[:, 1]]
-            else:
-                # Unexpected shape, log warning and use first column
-                print(f"Warning: Unexpected ONNX output shape {output_shape}, using first column")
-                scores = [float(score) for score in output_tensor[:, 0]]
-        else:
-            # Unexpected dimensionality, flatten and hope for the best
-            print(f"Warning: Unexpected ONNX output dimensionality {output_shape}, flattening")
-            scores = [float(score) for score in output_tensor.flatten()[:len(request.documents)]]
-        
-        return RerankResponse(scores=scores)
-    else:
-        # Fallback to standard CrossEncoder
-        pairs = [[request.query, doc] for doc in request.documents]
-        scores = reranker.predict(pairs).tolist()
-        return RerankResponse(scores=scores)
+        for position, index in enumerate(misses):
+            cached[index] = miss_scores[position]
+            score_cache.put(keys[index], miss_scores[position])
+
+    scores: List[float] = [score for score in cached if score is not None]
+    return RerankResponse(scores=scores)
 
 
 @app.get("/health", response_model=HealthResponse)